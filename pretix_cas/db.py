@@ -0,0 +1,39 @@
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+from pretix.settings import config
+
+
+def get_replica_alias():
+    """
+    Returns the database alias the login path reads from. This is the replica database of pretix (configured in the
+    ``[replica]`` section of the pretix configuration file) if ``use_replica`` is enabled in the ``[pretix_cas]``
+    section, or the primary database otherwise.
+    """
+    if config.getboolean('pretix_cas', 'use_replica', fallback=False):
+        return settings.DATABASE_REPLICA
+    return DEFAULT_DB_ALIAS
+
+
+class LoginRouter:
+    """
+    Routes the database queries of a single CAS login.
+    Reads go to the replica until the first write happens. From then on, all reads go to the primary database as well,
+    so that the login can read its own writes (e.g. a user created during the same request) despite replication lag.
+    Writes are always sent to the primary database by pretix' own database router.
+    """
+
+    def __init__(self):
+        self.replica_alias = get_replica_alias()
+        self.has_written = False
+
+    @property
+    def read_alias(self):
+        return DEFAULT_DB_ALIAS if self.has_written else self.replica_alias
+
+    def use_primary(self):
+        """
+        Must be called before writing. Returns the alias of the primary database.
+        """
+        self.has_written = True
+        return DEFAULT_DB_ALIAS
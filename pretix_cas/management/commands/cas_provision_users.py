@@ -0,0 +1,276 @@
+import base64
+import csv
+import itertools
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError, transaction
+
+from pretix.base.models import Team, User
+
+from ... import auth_backend
+from ...models import CasAttributeTeamAssignmentRule
+from ...utils import get_fullname, get_matching_teams
+
+# Attributes that are read from a directory export. LDAP attribute names are case-insensitive, so they are matched
+# against this mapping in lowercase and stored under the name CAS uses for them.
+KNOWN_ATTRIBUTES = {name.lower(): name for name in ('mail', 'fullName', 'givenName', 'surname', 'ou', 'groupMembership')}
+MULTI_VALUED_ATTRIBUTES = ('ou', 'groupMembership')
+
+
+class Command(BaseCommand):
+    help = ('Creates CAS users and applies the team assignment rules ahead of their first login, '
+            'based on a directory export (CSV or LDIF).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='Path to the directory export')
+        parser.add_argument('--format', choices=('csv', 'ldif'),
+                            help='Format of the export. Guessed from the file extension if omitted.')
+        parser.add_argument('--separator', default=';',
+                            help='Separator for multi-valued ou/groupMembership columns in CSV exports (default: ";")')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of records written per transaction (default: 1000)')
+        parser.add_argument('--locale', default=settings.LANGUAGE_CODE, help='Locale for the new users')
+        parser.add_argument('--timezone', default=settings.TIME_ZONE, help='Timezone for the new users')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be created, without writing to the database')
+
+    def handle(self, *args, **options):
+        file_format = options['format'] or ('ldif' if options['file'].lower().endswith('.ldif') else 'csv')
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be a positive number.')
+
+        self.options = options
+        self.stats = {
+            'records': 0,
+            'skipped_without_mail': 0,
+            'skipped_duplicates': 0,
+            'skipped_other_backend': 0,
+            'users_existing': 0,
+            'users_created': 0,
+            'memberships_attempted': 0,
+        }
+        self.seen_emails = set()
+        self.assignment_rules = list(CasAttributeTeamAssignmentRule.objects.select_related('team'))
+
+        try:
+            f = open(options['file'], 'rb')
+        except OSError as e:
+            raise CommandError('Could not read %s: %s' % (options['file'], e))
+
+        with f:
+            lines = decode_lines(f)
+            if file_format == 'ldif':
+                records = read_ldif(lines)
+            else:
+                records = read_csv(lines, options['separator'])
+
+            while True:
+                try:
+                    chunk = list(itertools.islice(records, options['batch_size']))
+                except ValueError as e:
+                    # Raised for malformed exports, including files that are not UTF-8 encoded
+                    raise CommandError('Could not read %s, %s (all previous chunks have already been processed)'
+                                       % (options['file'], e))
+                if not chunk:
+                    break
+                self.process_chunk(chunk)
+
+        self.report()
+
+    def process_chunk(self, records):
+        """
+        Creates the missing users of one chunk and bulk inserts their missing team memberships.
+        """
+        users_by_email = {}
+        for record in records:
+            self.stats['records'] += 1
+            email = record.get('mail', '').strip().lower()
+            if not email:
+                self.stats['skipped_without_mail'] += 1
+                continue
+            if email in self.seen_emails:
+                self.stats['skipped_duplicates'] += 1
+                continue
+            self.seen_emails.add(email)
+            record['mail'] = email
+            users_by_email[email] = record
+
+        existing_users = {user.email: user for user in User.objects.filter(email__in=users_by_email.keys())}
+
+        with transaction.atomic():
+            assignments = []
+            for email, record in users_by_email.items():
+                created = False
+                user = existing_users.get(email)
+                if user is None:
+                    if self.options['dry_run']:
+                        created = True
+                    else:
+                        user, created = self.create_user(record)
+
+                if created:
+                    self.stats['users_created'] += 1
+                elif user.auth_backend != auth_backend.CasAuthBackend.identifier:
+                    self.stats['skipped_other_backend'] += 1
+                    continue
+                else:
+                    self.stats['users_existing'] += 1
+
+                teams = get_matching_teams(self.assignment_rules, record.get('ou'), record.get('groupMembership'))
+                assignments.extend((user, team) for team in teams)
+
+            self.add_memberships(assignments)
+
+    def create_user(self, record):
+        """
+        Creates a user and returns it together with whether it has been created. If the user has been created in the
+        meantime (e.g. by a CAS login), the existing user is returned instead.
+        """
+        # Created through the model (instead of bulk_create) so pretix' own logic for new users still runs.
+        # All of them share a single transaction per chunk, though, with a savepoint for every user.
+        try:
+            with transaction.atomic():
+                return User.objects.create(
+                    email=record['mail'],
+                    fullname=get_fullname(record),
+                    locale=self.options['locale'],
+                    timezone=self.options['timezone'],
+                    auth_backend=auth_backend.CasAuthBackend.identifier,
+                    password='',
+                ), True
+        except IntegrityError:
+            return User.objects.get(email=record['mail']), False
+
+    def add_memberships(self, assignments):
+        """
+        Inserts all (user, team) memberships that do not exist yet with a single query.
+        In a dry run, new users do not have a primary key, so all of their memberships are counted as missing.
+        Memberships inserted concurrently (e.g. by a login) between the check and the insert are silently skipped by the
+        database, so the number of inserted memberships is only reported as attempted.
+        """
+        membership_model = Team.members.through
+        known_users = {user.pk for user, team in assignments if user is not None and user.pk is not None}
+        existing = set(membership_model.objects.filter(user_id__in=known_users)
+                       .values_list('user_id', 'team_id')) if known_users else set()
+
+        missing = [(user, team) for user, team in assignments
+                   if user is None or (user.pk, team.pk) not in existing]
+        self.stats['memberships_attempted'] += len(missing)
+
+        if not self.options['dry_run']:
+            membership_model.objects.bulk_create(
+                [membership_model(user_id=user.pk, team_id=team.pk) for user, team in missing],
+                batch_size=self.options['batch_size'],
+                ignore_conflicts=True,
+            )
+
+    def report(self):
+        if self.options['dry_run']:
+            self.stdout.write('Dry run, nothing has been written to the database.')
+            created = attempted = 'to be created'
+        else:
+            created = 'created'
+            attempted = 'attempted'
+
+        self.stdout.write('Records read: %d' % self.stats['records'])
+        self.stdout.write('Skipped without mail attribute: %d' % self.stats['skipped_without_mail'])
+        self.stdout.write('Skipped duplicates: %d' % self.stats['skipped_duplicates'])
+        self.stdout.write('Skipped (email registered with another backend): %d' % self.stats['skipped_other_backend'])
+        self.stdout.write('Users already existing: %d' % self.stats['users_existing'])
+        self.stdout.write('Users %s: %d' % (created, self.stats['users_created']))
+        self.stdout.write('Team memberships %s: %d' % (attempted, self.stats['memberships_attempted']))
+
+
+def decode_lines(stream):
+    """
+    Decodes a binary stream line by line, so that encoding errors can be reported with their line number.
+    """
+    for line_number, line in enumerate(stream, start=1):
+        try:
+            # utf-8-sig also accepts files starting with a byte order mark, as written by many spreadsheet tools
+            yield line.decode('utf-8-sig' if line_number == 1 else 'utf-8')
+        except UnicodeDecodeError as e:
+            raise ValueError('line %d: %s' % (line_number, e))
+
+
+def read_csv(lines, separator):
+    """
+    Reads a CSV export with a header row. Every column of KNOWN_ATTRIBUTES is optional except for 'mail', the
+    multi-valued columns contain their values joined by ``separator``.
+    """
+    reader = csv.DictReader(lines)
+    try:
+        header = reader.fieldnames or []
+    except csv.Error as e:
+        raise ValueError('line 1: %s' % e)
+    if 'mail' not in {KNOWN_ATTRIBUTES.get((column or '').strip().lower()) for column in header}:
+        raise ValueError('line 1: The CSV header has no mail column.')
+
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as e:
+            # line_num only counts the lines that have been read successfully
+            raise ValueError('line %d: %s' % (reader.line_num + 1, e))
+
+        record = {}
+        for column, value in row.items():
+            name = KNOWN_ATTRIBUTES.get((column or '').strip().lower())
+            if name is None or value is None or not value.strip():
+                continue
+            if name in MULTI_VALUED_ATTRIBUTES:
+                record[name] = [v.strip() for v in value.split(separator) if v.strip()]
+            else:
+                record[name] = value.strip()
+        yield record
+
+
+def read_ldif(lines):
+    """
+    Reads the entries of an LDIF export one at a time, supporting folded lines and base64 encoded values.
+    """
+    record = {}
+    current_line = None
+    current_line_number = 0
+    # The trailing empty line ensures that the last entry is yielded even without a blank line at the end of the file
+    for line_number, line in enumerate(itertools.chain(lines, ['']), start=1):
+        line = line.rstrip('\r\n')
+        if line.startswith(' ') and current_line is not None:
+            current_line += line[1:]
+            continue
+        if current_line is not None:
+            try:
+                _add_ldif_attribute(record, current_line)
+            except ValueError as e:
+                raise ValueError('line %d: Invalid value: %s' % (current_line_number, e))
+            current_line = None
+        if not line:
+            if record:
+                yield record
+            record = {}
+        elif not line.startswith('#'):
+            current_line = line
+            current_line_number = line_number
+
+
+def _add_ldif_attribute(record, line):
+    name, _, value = line.partition(':')
+    name = KNOWN_ATTRIBUTES.get(name.strip().lower())
+    if name is None:
+        return
+
+    if value.startswith(':'):
+        value = base64.b64decode(value[1:].strip()).decode('utf-8')
+    elif value.startswith('<'):
+        # Values referenced by URL are not supported
+        return
+    else:
+        value = value.strip()
+
+    if name in MULTI_VALUED_ATTRIBUTES:
+        record.setdefault(name, []).append(value)
+    else:
+        record.setdefault(name, value)
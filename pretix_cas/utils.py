@@ -0,0 +1,43 @@
+def get_fullname(user_info):
+    """
+    Tries to determine the full name of a user from the fields in the CAS payload.
+    :param user_info: The attribute dictionary returned by CAS (or read from a directory export).
+    :return: The full name, or an empty string if no name attributes are present.
+    """
+    if "fullName" in user_info:
+        return user_info['fullName']
+    elif "givenName" in user_info and "surname" in user_info:
+        return '%s, %s' % (user_info['surname'], user_info['givenName'])
+    elif "surname" in user_info:
+        return user_info['surname']
+    elif "givenName" in user_info:
+        return user_info['givenName']
+    return ""
+
+
+def as_attribute_list(attributes):
+    """
+    The response from the CAS server can respond with None, an empty list, a single attribute, or a list with
+    attributes. This normalizes all of these cases to a list.
+    """
+    if attributes is None:
+        return []
+    if type(attributes) is not list:
+        return [attributes]
+    return attributes
+
+
+def get_matching_teams(assignment_rules, ou_attributes=None, group_membership_attributes=None):
+    """
+    Determines the teams a user should be assigned to based on the given assignment rules.
+
+    :param assignment_rules: An iterable of 'CasAttributeTeamAssignmentRule' objects
+    :param ou_attributes: The ou attributes of the user
+    :param group_membership_attributes: The groupMembership attributes of the user
+    :return: The set of matching 'Team' objects
+    """
+    ou_attributes = as_attribute_list(ou_attributes)
+    group_membership_attributes = as_attribute_list(group_membership_attributes)
+
+    return {matcher.team for matcher in assignment_rules
+            if (matcher.attribute in ou_attributes or matcher.attribute in group_membership_attributes)}
@@ -16,8 +16,10 @@ from pretix.helpers.urls import build_absolute_uri
 from pretix.settings import config
 
 from . import auth_backend
+from .db import LoginRouter
 from .forms import CasAssignmentRuleForm
 from .models import CasAttributeTeamAssignmentRule
+from .utils import get_fullname, get_matching_teams
 
 
 def return_from_sso(request):
@@ -32,19 +34,26 @@ def return_from_sso(request):
     else:
         # See __create_new_user_from_cas_data for data format
         email = cas_response[1]['mail']
+        router = LoginRouter()
         try:
-            user = User.objects.filter(email=email).get()
+            user = User.objects.using(router.read_alias).filter(email=email).get()
         except ObjectDoesNotExist:
-            locale = request.LANGUAGE_CODE if hasattr(request, 'LANGUAGE_CODE') else settings.LANGUAGE_CODE
-            timezone = request.timezone if hasattr(request, 'timezone') else settings.TIME_ZONE
-            user = __create_new_user_from_cas_data(cas_response, locale, timezone)
+            # The user might have been created recently and not be replicated yet, so check the primary database
+            # before creating it there.
+            router.use_primary()
+            try:
+                user = User.objects.filter(email=email).get()
+            except ObjectDoesNotExist:
+                locale = request.LANGUAGE_CODE if hasattr(request, 'LANGUAGE_CODE') else settings.LANGUAGE_CODE
+                timezone = request.timezone if hasattr(request, 'timezone') else settings.TIME_ZONE
+                user = __create_new_user_from_cas_data(cas_response, locale, timezone)
 
         if user.auth_backend != auth_backend.CasAuthBackend.identifier:
             return HttpResponseBadRequest(_('Could not create user: Email is already registered.'))
 
         group_membership = cas_response[1].get('groupMembership')
         ou = cas_response[1].get('ou')
-        __add_user_to_teams(user, group_membership, ou)
+        __add_user_to_teams(user, group_membership, ou, router)
 
         return process_login(request, user, False)
 
@@ -145,18 +154,7 @@ def __create_new_user_from_cas_data(cas_response, locale, timezone):
 
     # email attribute is always required
     email = user_info['mail']
-
-    # Try to determine a name
-    if "fullName" in user_info:
-        fullname = user_info['fullName']
-    elif "givenName" in user_info and "surname" in user_info:
-        fullname = '%s, %s' % (user_info['surname'], user_info['givenName'])
-    elif "surname" in user_info:
-        fullname = user_info['surname']
-    elif "givenName" in user_info:
-        fullname = user_info['givenName']
-    else:
-        fullname = ""
+    fullname = get_fullname(user_info)
 
     created_user = User.objects.create(
         email=email,
@@ -170,32 +168,30 @@ def __create_new_user_from_cas_data(cas_response, locale, timezone):
     return created_user
 
 
-def __add_user_to_teams(user, ou_attributes=None, group_membership_attributes=None):
+def __add_user_to_teams(user, ou_attributes, group_membership_attributes, router):
     """
     Assigns users to teams based on the set assignment rules.
-    It doesn't matter whether the user is already in the team, or not.
+    It doesn't matter whether the user is already in the team, or not. The rules and existing memberships are read
+    through the router, the primary database is only used if the user has to be added to a team.
 
     :param user: The pretix 'User' object of the user that logged in
     :param ou_attributes: The list of ou attributes of the user received by the CAS server
     :param group_membership_attributes: The list of groupMembership attributes of the user received by the CAS server
+    :param router: The 'LoginRouter' of the current login
     """
-    # The response from the CAS server can respond with None, an empty list, a single attribute, or a list with
-    # attributes
-    if ou_attributes is None:
-        ou_attributes = []
-    if type(ou_attributes) is not list:
-        ou_attributes = [ou_attributes]
-    if group_membership_attributes is None:
-        group_membership_attributes = []
-    if type(group_membership_attributes) is not list:
-        group_membership_attributes = [group_membership_attributes]
-
-    assignment_rules = CasAttributeTeamAssignmentRule.objects.all()
-
-    teams = {matcher.team for matcher in assignment_rules
-             if (matcher.attribute in ou_attributes or matcher.attribute in group_membership_attributes)}
-
-    for team in teams:
+    assignment_rules = CasAttributeTeamAssignmentRule.objects.using(router.read_alias).select_related('team')
+    teams = get_matching_teams(assignment_rules, ou_attributes, group_membership_attributes)
+    if not teams:
+        return
+
+    existing_team_ids = set(Team.members.through.objects.using(router.read_alias)
+                            .filter(user_id=user.pk, team_id__in=[team.pk for team in teams])
+                            .values_list('team_id', flat=True))
+    missing_teams = [team for team in teams if team.pk not in existing_team_ids]
+    if missing_teams:
+        router.use_primary()
+
+    for team in missing_teams:
         try:
             team.members.add(user)
         except ObjectDoesNotExist:
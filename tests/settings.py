@@ -0,0 +1,11 @@
+from pretix.testutils.settings import *  # NOQA
+from pretix.testutils.settings import DATABASES
+
+# A second, independent database that is used as read replica in the tests of the login path, routed the same way
+# pretix does when a [replica] section is configured. The tests copy the rows that should be "replicated" to it
+# explicitly.
+DATABASES['replica'] = dict(DATABASES['default'])
+if DATABASES['replica']['ENGINE'] != 'django.db.backends.sqlite3':
+    DATABASES['replica']['TEST'] = {'NAME': 'test_%s_replica' % DATABASES['default']['NAME']}
+DATABASE_REPLICA = 'replica'
+DATABASE_ROUTERS = ['pretix.helpers.database.ReplicaRouter']
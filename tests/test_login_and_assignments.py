@@ -1,11 +1,17 @@
+import copy
+
 import pytest
+from django.db import connections
 from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
 
 from pretix_cas import views, auth_backend
+from pretix_cas.db import LoginRouter, get_replica_alias
 from pretix_cas.models import CasAttributeTeamAssignmentRule
 from rest_framework.reverse import reverse
 
 from pretix.base.models import User, Team, Organizer
+from pretix.settings import config
 
 fake_cas_data = ('ab12abcd',
                  {'mail': 'john.doe@tu-darmstadt.de', 'eduPersonAffiliation': ['student', 'member', 'employee'],
@@ -37,6 +43,30 @@ def env():
     return central_it_team, admin_team, employee_team
 
 
+@pytest.fixture
+def use_replica(monkeypatch):
+    original_getboolean = config.getboolean
+
+    def getboolean(section, option, *args, **kwargs):
+        if (section, option) == ('pretix_cas', 'use_replica'):
+            return True
+        return original_getboolean(section, option, *args, **kwargs)
+
+    monkeypatch.setattr(config, 'getboolean', getboolean)
+
+
+def replicate(*instances):
+    # Simulates replication by copying the rows with their primary keys to the replica
+    for instance in instances:
+        type(instance).objects.using('replica').bulk_create([copy.copy(instance)])
+
+
+def queries_on(context, model, where=''):
+    table = 'FROM "%s"' % model._meta.db_table
+    return [query['sql'] for query in context.captured_queries
+            if table in query['sql'] and where in query['sql'].partition('WHERE')[2]]
+
+
 @pytest.mark.django_db
 @override_settings(PRETIX_AUTH_BACKENDS=['pretix_cas.auth_backend.CasAuthBackend'])
 def test_successful_user_creation(env, client):
@@ -290,3 +320,80 @@ def test_add_rules_in_settings_insufficient_permissions(env, client):
     assert response.status_code == 404
 
     client.logout()
+
+
+def test_replica_alias_defaults_to_primary():
+    assert get_replica_alias() == 'default'
+
+
+def test_replica_alias_with_replica_enabled(use_replica):
+    assert get_replica_alias() == 'replica'
+
+
+def test_login_router_reads_own_writes(use_replica):
+    router = LoginRouter()
+    assert router.read_alias == 'replica'
+    router.use_primary()
+    assert router.read_alias == 'default'
+
+
+@pytest.mark.django_db(databases=['default', 'replica'])
+@override_settings(PRETIX_AUTH_BACKENDS=['pretix_cas.auth_backend.CasAuthBackend'])
+def test_repeated_login_reads_from_replica(env, client, use_replica):
+    central_it_team = env[0]
+    rule = CasAttributeTeamAssignmentRule.objects.create(attribute="ou=central-it", team=central_it_team)
+    login_mock(fake_cas_data, client)
+    user = get_user(fake_cas_data)
+    membership = Team.members.through.objects.get(user=user, team=central_it_team)
+    replicate(central_it_team.organizer, central_it_team, rule, user, membership)
+
+    with CaptureQueriesContext(connections['default']) as primary_queries, \
+            CaptureQueriesContext(connections['replica']) as replica_queries:
+        login_mock(fake_cas_data, client)
+
+    assert queries_on(replica_queries, User, 'email')
+    assert queries_on(replica_queries, CasAttributeTeamAssignmentRule)
+    assert queries_on(replica_queries, Team.members.through)
+    assert not queries_on(primary_queries, User, 'email')
+    assert not queries_on(primary_queries, CasAttributeTeamAssignmentRule)
+    assert not queries_on(primary_queries, Team.members.through)
+    assert User.objects.count() == 1
+    assert user.teams.count() == 1
+
+
+@pytest.mark.django_db(databases=['default', 'replica'])
+@override_settings(PRETIX_AUTH_BACKENDS=['pretix_cas.auth_backend.CasAuthBackend'])
+def test_login_with_user_not_yet_on_replica(env, client, use_replica):
+    central_it_team = env[0]
+    employee_team = env[2]
+    first_rule = CasAttributeTeamAssignmentRule.objects.create(attribute="ou=central-it", team=central_it_team)
+    login_mock(fake_cas_data, client)
+    # The user and its first membership have not been replicated yet
+    second_rule = CasAttributeTeamAssignmentRule.objects.create(attribute="T20", team=employee_team)
+    replicate(central_it_team.organizer, central_it_team, employee_team, first_rule, second_rule)
+
+    login_mock(fake_cas_data, client)
+
+    assert User.objects.count() == 1
+    assert User.objects.using('replica').count() == 0
+    user = get_user(fake_cas_data)
+    assert is_part_of_team(user, central_it_team)
+    assert is_part_of_team(user, employee_team)
+    assert user.teams.count() == 2
+
+
+@pytest.mark.django_db(databases=['default', 'replica'])
+@override_settings(PRETIX_AUTH_BACKENDS=['pretix_cas.auth_backend.CasAuthBackend'])
+def test_first_login_writes_to_primary_only(env, client, use_replica):
+    central_it_team = env[0]
+    rule = CasAttributeTeamAssignmentRule.objects.create(attribute="ou=central-it", team=central_it_team)
+    replicate(central_it_team.organizer, central_it_team, rule)
+
+    with CaptureQueriesContext(connections['replica']) as replica_queries:
+        login_mock(fake_cas_data, client)
+
+    # The user is created in this request, so its memberships have to be read from the primary database
+    assert not queries_on(replica_queries, Team.members.through)
+    assert is_part_of_team(get_user(fake_cas_data), central_it_team)
+    assert User.objects.using('replica').count() == 0
+    assert Team.members.through.objects.using('replica').count() == 0
@@ -0,0 +1,163 @@
+from io import StringIO
+
+import pytest
+from django.core.management import CommandError, call_command
+
+from pretix_cas import auth_backend
+from pretix_cas.management.commands.cas_provision_users import Command
+from pretix_cas.models import CasAttributeTeamAssignmentRule
+
+from pretix.base.models import Organizer, Team, User
+
+csv_export = '''mail,givenName,surname,ou,groupMembership
+john.doe@tu-darmstadt.de,John,Doe,T20;FB20,cn=T20;ou=central-it;o=tu-darmstadt
+jane.doe@tu-darmstadt.de,Jane,Doe,FB00,
+,No,Mail,FB20,
+'''
+
+ldif_export = '''version: 1
+
+dn: uid=ab12abcd,ou=people,o=tu-darmstadt
+mail: john.doe@tu-darmstadt.de
+fullName: Doe, John
+ou: T20
+ou: FB20
+groupMembership: ou=central-it
+
+dn: uid=cd34efgh,ou=people,o=tu-darmstadt
+mail: jane.doe@tu-darmstadt.de
+givenName:: SsO2cmc=
+ou: FB00
+'''
+
+
+@pytest.fixture
+def env():
+    organizer = Organizer.objects.create(name="FB 20", slug="FB20")
+    central_it_team = Team.objects.create(name="Central IT", organizer=organizer, can_view_orders=True)
+    employee_team = Team.objects.create(name="Employees", organizer=organizer, can_view_vouchers=True)
+    CasAttributeTeamAssignmentRule.objects.create(attribute="ou=central-it", team=central_it_team)
+    CasAttributeTeamAssignmentRule.objects.create(attribute="FB20", team=employee_team)
+    return central_it_team, employee_team
+
+
+def provision(tmp_path, content, filename='export.csv', args=(), encoding='utf-8'):
+    export = tmp_path / filename
+    export.write_text(content, encoding=encoding)
+    out = StringIO()
+    call_command('cas_provision_users', str(export), *args, stdout=out)
+    return out.getvalue()
+
+
+@pytest.mark.django_db
+def test_provision_from_csv(env, tmp_path):
+    central_it_team, employee_team = env
+    provision(tmp_path, csv_export)
+
+    assert User.objects.count() == 2
+    john = User.objects.get(email='john.doe@tu-darmstadt.de')
+    assert john.get_full_name() == 'Doe, John'
+    assert john.auth_backend == auth_backend.CasAuthBackend.identifier
+    assert set(john.teams.all()) == {central_it_team, employee_team}
+    assert User.objects.get(email='jane.doe@tu-darmstadt.de').teams.count() == 0
+
+
+@pytest.mark.django_db
+def test_provision_from_ldif(env, tmp_path):
+    central_it_team, employee_team = env
+    provision(tmp_path, ldif_export, 'export.ldif')
+
+    john = User.objects.get(email='john.doe@tu-darmstadt.de')
+    assert john.get_full_name() == 'Doe, John'
+    assert set(john.teams.all()) == {central_it_team, employee_team}
+    assert User.objects.get(email='jane.doe@tu-darmstadt.de').get_full_name() == 'Jörg'
+
+
+@pytest.mark.django_db
+def test_provision_is_idempotent_and_chunked(env, tmp_path):
+    provision(tmp_path, csv_export, args=('--batch-size', '1'))
+    provision(tmp_path, csv_export, args=('--batch-size', '1'))
+
+    assert User.objects.count() == 2
+    assert User.objects.get(email='john.doe@tu-darmstadt.de').teams.count() == 2
+
+
+@pytest.mark.django_db
+def test_provision_dry_run(env, tmp_path):
+    output = provision(tmp_path, csv_export, args=('--dry-run',))
+
+    assert User.objects.count() == 0
+    assert 'Users to be created: 2' in output
+    assert 'Team memberships to be created: 2' in output
+
+
+@pytest.mark.django_db
+def test_provision_skips_users_of_other_backends(env, tmp_path):
+    User.objects.create_user('john.doe@tu-darmstadt.de', 'password')
+    provision(tmp_path, csv_export)
+
+    assert User.objects.get(email='john.doe@tu-darmstadt.de').teams.count() == 0
+
+
+@pytest.mark.django_db
+def test_provision_only_adds_missing_memberships(env, tmp_path):
+    central_it_team, employee_team = env
+    john = User.objects.create(email='john.doe@tu-darmstadt.de', auth_backend=auth_backend.CasAuthBackend.identifier)
+    central_it_team.members.add(john)
+
+    output = provision(tmp_path, csv_export)
+
+    assert 'Users already existing: 1' in output
+    assert 'Team memberships attempted: 1' in output
+    assert set(john.teams.all()) == {central_it_team, employee_team}
+
+
+@pytest.mark.django_db
+def test_provision_from_csv_with_byte_order_mark(env, tmp_path):
+    provision(tmp_path, csv_export, encoding='utf-8-sig')
+
+    assert User.objects.count() == 2
+
+
+@pytest.mark.django_db
+def test_provision_csv_without_mail_column(env, tmp_path):
+    with pytest.raises(CommandError):
+        provision(tmp_path, 'email,ou\njohn.doe@tu-darmstadt.de,FB20\n')
+
+    assert User.objects.count() == 0
+
+
+@pytest.mark.django_db
+def test_provision_invalid_ldif_value(env, tmp_path):
+    with pytest.raises(CommandError, match='line 3'):
+        provision(tmp_path, 'dn: uid=ab12abcd\nmail: john.doe@tu-darmstadt.de\ngivenName:: QQ\n', 'export.ldif')
+
+
+@pytest.mark.django_db
+def test_provision_user_created_concurrently(env, tmp_path, monkeypatch):
+    central_it_team, employee_team = env
+    create_user = Command.create_user
+
+    def create_user_after_login(self, record):
+        # Simulates a CAS login creating the user between the lookup and the insert of the command
+        User.objects.create(email=record['mail'], auth_backend=auth_backend.CasAuthBackend.identifier)
+        return create_user(self, record)
+
+    monkeypatch.setattr(Command, 'create_user', create_user_after_login)
+    output = provision(tmp_path, csv_export)
+
+    assert 'Users created: 0' in output
+    assert 'Users already existing: 2' in output
+    assert User.objects.count() == 2
+    assert set(User.objects.get(email='john.doe@tu-darmstadt.de').teams.all()) == {central_it_team, employee_team}
+
+
+@pytest.mark.django_db
+def test_provision_reports_line_of_invalid_encoding(env, tmp_path):
+    export = tmp_path / 'export.csv'
+    export.write_bytes(csv_export.encode('utf-8') + b'j\xf6rg@tu-darmstadt.de,,,,\n')
+
+    with pytest.raises(CommandError, match='line 5'):
+        call_command('cas_provision_users', str(export), '--batch-size', '1', stdout=StringIO())
+
+    assert User.objects.count() == 2